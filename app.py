@@ -1,23 +1,34 @@
 # app.py — BLiP Unique Users (core, simples, resiliente)
 from __future__ import annotations
 
+import io
 import os
 import re
 import json
+import hashlib
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta, timezone
 from typing import Any, Dict, List, Tuple
 from urllib.parse import quote
 
+import numpy as np
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 import streamlit as st
-import matplotlib.pyplot as plt
 from zoneinfo import ZoneInfo
 
 API_URL = "https://http.msging.net/commands"
 ANALYTICS_TO = "postmaster@analytics.msging.net"
 DEFAULT_TZ = "America/Sao_Paulo"
+BUCKETS = ["Dentro", "Fora"]
+DIAS_SEMANA = ["Segunda-feira", "Terça-feira", "Quarta-feira", "Quinta-feira", "Sexta-feira", "Sábado", "Domingo"]
+EVENT_FIELDS = ("storageDate", "eventDate", "contact", "from")
 
 # ------------------------- UI: Config básica -------------------------
 
@@ -43,7 +54,8 @@ action = st.sidebar.text_input("Ação/Bloco (flow)", value="Início")
 period_mode = st.sidebar.radio("Período", ["Últimos N dias", "Intervalo de datas"], horizontal=True)
 if period_mode == "Últimos N dias":
     days = st.sidebar.slider("N dias", 1, 90, 30)
-    end_dt = datetime.now(timezone.utc)
+    # arredonda ao minuto para que reruns próximos reaproveitem o cache da coleta
+    end_dt = datetime.now(timezone.utc).replace(second=0, microsecond=0)
     start_dt = end_dt - timedelta(days=days)
 else:
     utc_today = datetime.now(timezone.utc).date()
@@ -61,17 +73,27 @@ run = st.sidebar.button("Buscar & Analisar", type="primary")
 
 # ------------------------- Core: utilidades -------------------------
 
+# "Identity"/"identity" em JSON ou repr de dict (aspas simples ou duplas)
+_IDENTITY_RE = re.compile(r"[\"'][Ii]dentity[\"']\s*:\s*[\"']([^\"']+)[\"']")
+
+_TZ_CACHE: Dict[str, ZoneInfo] = {}
+
+def _get_tz(name: str) -> ZoneInfo:
+    tz = _TZ_CACHE.get(name)
+    if tz is None:
+        tz = _TZ_CACHE[name] = ZoneInfo(name)
+    return tz
+
 def to_iso_z(dt: datetime) -> str:
     return dt.astimezone(timezone.utc).isoformat(timespec="seconds").replace("+00:00", "Z")
 
-def business_bucket(hour: int, start_h: int, end_h: int) -> str:
-    try:
-        h = int(hour)
-    except Exception:
-        return "Fora"
+def business_bucket(hours: pd.Series, start_h: int, end_h: int) -> pd.Categorical:
     if start_h <= end_h:
-        return "Dentro" if (start_h <= h < end_h) else "Fora"
-    return "Dentro" if (h >= start_h or h < end_h) else "Fora"
+        inside = (hours >= start_h) & (hours < end_h)
+    else:
+        inside = (hours >= start_h) | (hours < end_h)
+    # código 0 = Dentro, 1 = Fora (mesma ordem das colunas nos gráficos)
+    return pd.Categorical.from_codes(np.where(inside, 0, 1).astype(np.int8), categories=BUCKETS)
 
 def safe_json(obj: Any) -> Dict[str, Any]:
     if isinstance(obj, dict):
@@ -89,15 +111,73 @@ def extract_identity(contact_field: Any) -> str | None:
     for k in ("identity", "Identity"):
         if isinstance(d.get(k), str):
             return d[k]
-    m = re.search(r"[\"']Identity[\"']\s*:\s*[\"']([^\"']+)[\"']", str(contact_field))
+    m = _IDENTITY_RE.search(str(contact_field))
     return m.group(1) if m else None
 
-def to_local(ts: pd.Timestamp, tz: ZoneInfo) -> pd.Timestamp:
-    if pd.isna(ts): return ts
-    if ts.tzinfo is None: ts = ts.tz_localize(timezone.utc)
-    return ts.tz_convert(tz)
-
-# ------------------------- Core: coleta (retry simples) -------------------------
+def extract_identities(contacts: pd.Series) -> pd.Series:
+    # dicts vão pelo caminho escalar (barato); o resto passa por um único str.extract
+    is_dict = contacts.map(lambda c: isinstance(c, dict)).astype(bool)
+    ids = pd.Series(index=contacts.index, dtype=object)
+    if is_dict.any():
+        ids[is_dict] = contacts[is_dict].map(extract_identity)
+    if not is_dict.all():
+        ids[~is_dict] = contacts[~is_dict].astype(str).str.extract(_IDENTITY_RE, expand=False)
+    return ids
+
+# ------------------------- Core: coleta (paralela, retry simples) -------------------------
+
+class IncompleteFetch(RuntimeError):
+    # coleta interrompida por erro: carrega o parcial, mas não deve entrar no cache
+    def __init__(self, items: List[Dict[str, Any]]):
+        super().__init__(f"Coleta incompleta ({len(items)} eventos)")
+        self.items = items
+
+@st.cache_resource
+def _session() -> requests.Session:
+    # conexão TCP+TLS reaproveitada entre páginas, janelas e reruns
+    s = requests.Session()
+    s.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=0))
+    s.headers.update({"Content-Type": "application/json"})
+    return s
+
+def split_window(start_iso: str, end_iso: str, parts: int) -> List[Tuple[str, str]]:
+    # janelas contíguas: o fim de uma é o início da próxima (datas da API têm
+    # milissegundos; cortar em "próxima - 1s" perderia eventos na fronteira).
+    # Eventos no segundo da fronteira podem vir nas duas janelas: ver `_dedupe_boundary`
+    start = datetime.fromisoformat(start_iso.replace("Z", "+00:00"))
+    end = datetime.fromisoformat(end_iso.replace("Z", "+00:00"))
+    step = (end - start) / max(parts, 1)
+    if step < timedelta(seconds=1):
+        return [(start_iso, end_iso)]
+    bounds = [start + step * i for i in range(parts)] + [end]
+    windows = [(to_iso_z(bounds[i]), to_iso_z(bounds[i + 1])) for i in range(parts - 1)]
+    windows.append((to_iso_z(bounds[-2]), end_iso))
+    return windows
+
+def _dedupe_boundary(prev: List[Dict[str, Any]], cur: List[Dict[str, Any]], boundary_iso: str) -> List[Dict[str, Any]]:
+    # remove de `cur` os eventos do segundo da fronteira que já vieram em `prev`
+    sec = boundary_iso[:19]
+
+    def _na_fronteira(e: Dict[str, Any]) -> bool:
+        return any(str(e.get(k) or "")[:19] == sec for k in ("storageDate", "eventDate"))
+
+    vistos = {orjson.dumps(e, option=orjson.OPT_SORT_KEYS, default=str) for e in prev if _na_fronteira(e)}
+    if not vistos:
+        return cur
+    return [e for e in cur if not (_na_fronteira(e) and orjson.dumps(e, option=orjson.OPT_SORT_KEYS, default=str) in vistos)]
+
+def _newest_first(items: List[Dict[str, Any]]) -> bool | None:
+    # sentido da paginação pela data do 1º e do último evento da página; None se indefinido
+    try:
+        a, b = (
+            datetime.fromisoformat(str(e.get("storageDate") or e.get("eventDate")).replace("Z", "+00:00"))
+            for e in (items[0], items[-1])
+        )
+    except (IndexError, ValueError):
+        return None
+    if a == b:
+        return None
+    return a > b
 
 def fetch_events(
     api_key: str,
@@ -108,86 +188,198 @@ def fetch_events(
     max_events: int = 10000,
     max_retries: int = 5,
     base_sleep: float = 0.8,
+    workers: int = 8,
 ) -> List[Dict[str, Any]]:
     enc_action = quote(action)
-    collected: List[Dict[str, Any]] = []
-    skip = 0
-    attempt = 0
+    windows = split_window(start_iso, end_iso, workers)
+    session = _session()
+    stop = threading.Event()
+    lock = threading.Lock()
+    counts = [0] * len(windows)
+    done = [False] * len(windows)
+    # a ordem da API (mais antigos ou mais recentes primeiro) não é documentada:
+    # é detectada nas próprias páginas; até lá assume mais antigos primeiro
+    newest_first = False
+
+    def _priority() -> List[int]:
+        ordem = list(range(len(windows)))
+        return ordem[::-1] if newest_first else ordem
+
+    # corte determinístico em max_events: o resultado é o mesmo prefixo que a
+    # paginação sequencial devolveria, com as janelas na ordem da API. A janela i
+    # para quando as que vêm antes dela já somam o bastante, ou quando ela mesma
+    # fecha o prefixo com todas as anteriores completas. Chamar com `lock`.
+    def _prefix_full(i: int) -> bool:
+        ordem = _priority()
+        acumulado = 0
+        for pos, j in enumerate(ordem):
+            acumulado += counts[j]
+            if acumulado >= max_events:
+                pos_i = ordem.index(i)
+                return pos_i > pos or (pos_i == pos and all(done[k] for k in ordem[:pos]))
+        return False
+
+    # roda fora da thread do Streamlit: nada de st.* aqui, só devolve avisos/erro
+    def _fetch_one_window(i: int, w_start: str, w_end: str) -> Tuple[List[Dict[str, Any]], List[str], str | None]:
+        nonlocal newest_first
+        items_w: List[Dict[str, Any]] = []
+        avisos: List[str] = []
+        skip = 0
+        attempt = 0
+        while True:
+            with lock:
+                if stop.is_set() or _prefix_full(i):
+                    break
+            uri = f"/event-track/flow/{enc_action}?$take={take}&$skip={skip}&startDate={w_start}&endDate={w_end}"
+            payload = {"id": f"get-events-{action}-{w_start}-{skip}", "to": ANALYTICS_TO, "method": "get", "uri": uri}
+            # a sessão é compartilhada entre usuários: a chave vai por requisição
+            headers = {"Authorization": f"Key {api_key}"}
+
+            try:
+                resp = session.post(API_URL, headers=headers, json=payload, timeout=45)
+                if resp.status_code == 401:
+                    raise RuntimeError("401 Unauthorized: verifique a chave (sem 'Key '), bot correto e gere nova se necessário.")
+                if resp.status_code in (429, 500, 502, 503, 504):
+                    # backoff simples e retry controlado (por janela)
+                    if attempt < max_retries:
+                        sleep_s = base_sleep * (2 ** attempt)
+                        avisos.append(f"Instabilidade ({resp.status_code}) em {w_start}. Nova tentativa após {sleep_s:.1f}s.")
+                        time.sleep(sleep_s)
+                        attempt += 1
+                        continue
+                    else:
+                        resp.raise_for_status()
+                resp.raise_for_status()
+                data = orjson.loads(resp.content)
+            except Exception as e:
+                # erro fatal ou estourou retries: interrompe as demais janelas também
+                stop.set()
+                return items_w, avisos, f"Erro ao buscar eventos ({w_start} → {w_end}, skip={skip}): {e}"
+
+            items = (data or {}).get("resource", {}).get("items", []) or []
+            # guarda só os campos analisados (menos memória no cache e no pickle)
+            items = [{k: it[k] for k in EVENT_FIELDS if k in it} for it in items]
+            items_w.extend(items)
+            sentido = _newest_first(items)
+            with lock:
+                if sentido is not None:
+                    newest_first = sentido
+                counts[i] += len(items)
+                done[i] = not items
+
+            if not items:
+                break
+            skip += take
+
+        return items_w, avisos, None
+
+    results: List[List[Dict[str, Any]]] = [[] for _ in windows]
+    falhou = False
+    with ThreadPoolExecutor(max_workers=len(windows)) as executor:
+        futures = {executor.submit(_fetch_one_window, i, a, b): i for i, (a, b) in enumerate(windows)}
+        coletados = 0
+        for fut in as_completed(futures):
+            i = futures[fut]
+            items_w, avisos, erro = fut.result()
+            for aviso in avisos:
+                st.info(aviso)
+            if erro:
+                st.error(erro)
+                falhou = True
+            results[i] = items_w
+            coletados += len(items_w)
+            a, b = windows[i]
+            st.write(f"Coletados {len(items_w)} eventos em {a} → {b} (total: {coletados})")
+
+    # janelas na ordem da API; o evento repetido na fronteira fica na que vem antes
+    ordem = _priority()
+    for prev, cur in zip(ordem, ordem[1:]):
+        results[cur] = _dedupe_boundary(results[prev], results[cur], windows[max(prev, cur)][0])
+
+    collected = [it for j in ordem for it in results[j]][:max_events]
+    if falhou:
+        raise IncompleteFetch(collected)
+    return collected
 
-    while True:
-        uri = f"/event-track/flow/{enc_action}?$take={take}&$skip={skip}&startDate={start_iso}&endDate={end_iso}"
-        payload = {"id": f"get-events-{action}-{skip}", "to": ANALYTICS_TO, "method": "get", "uri": uri}
-        headers = {"Authorization": f"Key {api_key}", "Content-Type": "application/json"}
+def payload_digest(raw: List[Dict[str, Any]]) -> str:
+    return hashlib.sha256(orjson.dumps(raw, option=orjson.OPT_SORT_KEYS, default=str)).hexdigest()
 
-        try:
-            resp = requests.post(API_URL, headers=headers, json=payload, timeout=45)
-            if resp.status_code == 401:
-                raise RuntimeError("401 Unauthorized: verifique a chave (sem 'Key '), bot correto e gere nova se necessário.")
-            if resp.status_code in (429, 500, 502, 503, 504):
-                # backoff simples e retry controlado
-                if attempt < max_retries:
-                    sleep_s = base_sleep * (2 ** attempt)
-                    st.info(f"Instabilidade ({resp.status_code}). Tentando de novo em {sleep_s:.1f}s…")
-                    time.sleep(sleep_s)
-                    attempt += 1
-                    continue
-                else:
-                    resp.raise_for_status()
-            resp.raise_for_status()
-            data = resp.json()
-        except Exception as e:
-            # erro fatal ou estourou retries
-            st.error(f"Erro ao buscar eventos (skip={skip}): {e}")
-            break
-
-        items = (data or {}).get("resource", {}).get("items", []) or []
-        collected.extend(items)
-        st.write(f"Coletados {len(items)} eventos (total: {len(collected)}) | skip={skip}")
-
-        if not items or len(collected) >= max_events:
-            break
-        skip += take
-
-    return collected
+@st.cache_data(ttl=3600, max_entries=8, show_spinner=False)
+def _cached_fetch(
+    action: str,
+    start_iso: str,
+    end_iso: str,
+    take: int,
+    max_events: int,
+    key_hash: str,
+    _api_key: str,
+) -> Tuple[List[Dict[str, Any]], str]:
+    # `_api_key` fica fora da chave do cache; `key_hash` separa contas diferentes
+    raw = fetch_events(_api_key, action, start_iso, end_iso, take=take, max_events=max_events)
+    return raw, payload_digest(raw)
 
 # ------------------------- Core: processamento -------------------------
 
+@st.cache_data(ttl=3600, max_entries=8, show_spinner=False)
 def preprocess_and_unique(
-    raw: List[Dict[str, Any]],
+    _raw: List[Dict[str, Any]],
+    raw_digest: str,
     tz_name: str,
     start_h: int,
     end_h: int,
 ) -> Tuple[pd.DataFrame, pd.DataFrame]:
-    df = pd.DataFrame(raw)
-    if df.empty:
-        return df, df
-
-    tz = ZoneInfo(tz_name)
-    # datas (UTC com fallback)
-    df["datetime_utc"] = pd.to_datetime(df.get("storageDate"), errors="coerce", utc=True)
-    if df["datetime_utc"].isna().all() and "eventDate" in df.columns:
-        df["datetime_utc"] = pd.to_datetime(df.get("eventDate"), errors="coerce", utc=True)
+    # `_raw` não é hasheado pelo Streamlit (lento em listas grandes); a chave é `raw_digest`
+    if not _raw:
+        return pd.DataFrame(), pd.DataFrame()
+
+    # esquema decidido uma vez pelo 1º evento (mesmo formato em toda a resposta):
+    # campo de data preenchido (storageDate nulo cai para eventDate) e fontes de identidade presentes
+    first = _raw[0]
+    ts_field = "storageDate" if first.get("storageDate") is not None else "eventDate"
+    id_fields = [k for k in ("contact", "from") if k in first]
+
+    # só as colunas usadas na análise, em vez de todos os campos do evento como object
+    df = pd.DataFrame({k: [r.get(k) for r in _raw] for k in (ts_field, *id_fields)})
+    if "from" in df.columns:
+        df["from"] = df["from"].astype(pd.StringDtype("pyarrow"))
+
+    tz = _get_tz(tz_name)
+    # datas (UTC)
+    df["datetime_utc"] = pd.to_datetime(df[ts_field], errors="coerce", utc=True, format="ISO8601", cache=True)
     df = df.dropna(subset=["datetime_utc"]).copy()
 
-    # local
-    df["datetime_local"] = df["datetime_utc"].apply(lambda x: to_local(x, tz))
-    df["hora"] = df["datetime_local"].dt.hour
+    # local: converte só os instantes distintos (rajadas no mesmo segundo são comuns)
+    # e espalha de volta pelo inverso do np.unique; hora e calendário também
+    utc = df["datetime_utc"].to_numpy(dtype="datetime64[ns]")
+    uniq, inv = np.unique(utc, return_inverse=True)
+    loc = pd.DatetimeIndex(uniq).tz_localize("UTC").tz_convert(tz)
+    df["datetime_local"] = loc[inv]
+    df["hora"] = loc.hour.to_numpy(dtype=np.int8)[inv]
+
+    # calendário (ano/semana ISO e dia da semana) calculado uma vez, junto da hora local;
+    # dayofweek 0..6 já segue a ordem Segunda → Domingo
+    iso = loc.isocalendar()
+    df["iso_year"] = iso["year"].to_numpy(dtype=np.int16)[inv]
+    df["iso_week"] = iso["week"].to_numpy(dtype=np.int8)[inv]
+    df["dia_semana"] = pd.Categorical.from_codes(loc.dayofweek.to_numpy()[inv], categories=DIAS_SEMANA, ordered=True)
 
     # identidade
-    df["user_id"] = df.get("contact").apply(extract_identity) if "contact" in df.columns else None
-    if df["user_id"].isna().all() and "from" in df.columns:
-        df["user_id"] = df["from"]
+    if "contact" in df.columns:
+        df["user_id"] = extract_identities(df["contact"])
+        # contact presente mas sem Identity em nenhum evento: cai para "from"
+        if "from" in df.columns and df["user_id"].isna().all():
+            df["user_id"] = df["from"]
+    else:
+        df["user_id"] = df["from"] if "from" in df.columns else None
 
     # bucket
-    df["horario_comercial"] = df["hora"].apply(lambda h: business_bucket(h, start_h, end_h))
-
-    # primeiro contato
-    df_unicos = (
-        df.sort_values("datetime_local")
-          .dropna(subset=["user_id"])
-          .drop_duplicates(subset=["user_id"], keep="first")
-          .reset_index(drop=True)
-    )
+    df["horario_comercial"] = business_bucket(df["hora"], start_h, end_h)
+
+    # primeiro contato: idxmin por usuário (hash, sem ordenar o df inteiro);
+    # só o conjunto de únicos é ordenado
+    mask = df["user_id"].notna()
+    idx = df.loc[mask].groupby("user_id", sort=False, observed=True)["datetime_local"].idxmin()
+    df_unicos = df.loc[idx.values].sort_values("datetime_local").reset_index(drop=True)
     return df, df_unicos
 
 def summarize(df_unicos: pd.DataFrame) -> Dict[str, Any]:
@@ -197,46 +389,122 @@ def summarize(df_unicos: pd.DataFrame) -> Dict[str, Any]:
 
     total = len(df_unicos)
 
+    # uma única passada de hash sobre os usuários; as visões abaixo só reagregam
+    # esse cubo (no máx. semanas × 7 × 24 × 2 linhas).
+    # observed=True: categorias sem ocorrência não geram o produto cartesiano
+    cubo = df_unicos.groupby(["iso_year", "iso_week", "dia_semana", "hora", "horario_comercial"], observed=True).size()
+
+    def _por(*niveis: str) -> pd.Series:
+        return cubo.groupby(level=list(niveis), observed=True).sum()
+
     # resumo
-    ordem = ["Dentro", "Fora"]
     resumo = (
-        df_unicos["horario_comercial"]
-        .value_counts()
-        .reindex(ordem, fill_value=0)
+        _por("horario_comercial")
+        .reindex(BUCKETS, fill_value=0)
         .rename_axis("Horário")
         .reset_index(name="Usuários únicos")
     )
     resumo["Percentual (%)"] = (resumo["Usuários únicos"] / total * 100).round(2)
 
-    # semana (ano ISO + semana ISO)
-    iso = df_unicos["datetime_local"].dt.isocalendar()
-    dfu = df_unicos.assign(iso_year=iso.year, iso_week=iso.week)
-
-    semana = (
-        dfu.groupby(["iso_year", "iso_week", "horario_comercial"], observed=False)
-        .size().unstack(fill_value=0).sort_index()
-    )
+    # semana
+    semana = _por("iso_year", "iso_week", "horario_comercial").unstack(fill_value=0).reindex(columns=BUCKETS, fill_value=0).sort_index()
     semana.index = [f"{y}-W{int(w):02d}" for y, w in semana.index]
 
     # dia
-    dias_ord = ["Segunda-feira","Terça-feira","Quarta-feira","Quinta-feira","Sexta-feira","Sábado","Domingo"]
-    dias_map = {
-        "Monday": "Segunda-feira","Tuesday": "Terça-feira","Wednesday": "Quarta-feira",
-        "Thursday": "Quinta-feira","Friday": "Sexta-feira","Saturday": "Sábado","Sunday": "Domingo",
-    }
-    # garante coluna traduzida
-    if "dia_semana" not in dfu.columns:
-        dfu["dia_semana"] = dfu["datetime_local"].dt.day_name().map(dias_map)
-    dfu["dia_semana"] = pd.Categorical(dfu["dia_semana"], categories=dias_ord, ordered=True)
-    dia = dfu.groupby(["dia_semana", "horario_comercial"], observed=False).size().unstack(fill_value=0).reindex(dias_ord)
+    dia = _por("dia_semana", "horario_comercial").unstack(fill_value=0).reindex(index=DIAS_SEMANA, columns=BUCKETS, fill_value=0)
 
     # hora
-    hora = dfu.groupby(["hora", "horario_comercial"], observed=False).size().unstack(fill_value=0).sort_index()
+    hora = _por("hora", "horario_comercial").unstack(fill_value=0).reindex(columns=BUCKETS, fill_value=0).sort_index()
 
     return {"total": total, "resumo": resumo, "semana": semana, "dia": dia, "hora": hora}
 
+# ------------------------- Export -------------------------
+
+def _objects_as_text(d: pd.DataFrame) -> pd.DataFrame:
+    # colunas object (ex.: contact com dicts e strings misturados) viram texto,
+    # para o hash do pandas e a conversão para Arrow
+    obj_cols = [c for c, t in d.dtypes.items() if t == object]
+    return d.astype({c: "string" for c in obj_cols})
+
+def frame_hash(d: pd.DataFrame) -> bytes:
+    # hash vetorizado do conteúdo
+    h = pd.util.hash_pandas_object(_objects_as_text(d), index=True)
+    return repr(list(d.columns)).encode("utf-8") + h.values.tobytes()
+
+@st.cache_data(ttl=3600, max_entries=8, show_spinner=False, hash_funcs={pd.DataFrame: frame_hash})
+def csv_bytes(df: pd.DataFrame) -> bytes:
+    # writer CSV do pyarrow (C++)
+    table = pa.Table.from_pandas(_objects_as_text(df), preserve_index=False)
+    buf = io.BytesIO()
+    pa_csv.write_csv(table, buf)
+    return buf.getvalue()
+
+# ------------------------- UI: gráficos -------------------------
+
+def pie_chart(resumo: pd.DataFrame) -> None:
+    # arco + rótulo de percentual (como o autopct do antigo gráfico de pizza)
+    spec = {
+        "width": "container",
+        "height": 320,
+        "transform": [{"calculate": "format(datum['Percentual (%)'], '.1f') + '%'", "as": "rotulo"}],
+        "encoding": {
+            "theta": {"field": "Usuários únicos", "type": "quantitative", "stack": True},
+            "color": {"field": "Horário", "type": "nominal", "sort": BUCKETS},
+        },
+        "layer": [
+            {
+                "mark": {"type": "arc", "outerRadius": 120, "tooltip": True},
+                "encoding": {
+                    "tooltip": [
+                        {"field": "Horário", "type": "nominal"},
+                        {"field": "Usuários únicos", "type": "quantitative"},
+                        {"field": "Percentual (%)", "type": "quantitative"},
+                    ],
+                },
+            },
+            {
+                "mark": {"type": "text", "radius": 140, "fontSize": 14},
+                "encoding": {"text": {"field": "rotulo", "type": "nominal"}},
+            },
+        ],
+    }
+    st.vega_lite_chart(resumo, spec)
+
+def stacked_bar(data: pd.DataFrame, x_title: str) -> None:
+    # formato longo (x, Horário, Usuários únicos); "sort": None preserva a ordem do índice
+    long = data.copy()
+    long.index = long.index.astype(str)
+    long.columns = long.columns.astype(str)
+    long = long.rename_axis("x").reset_index().melt(id_vars="x", var_name="Horário", value_name="Usuários únicos")
+    spec = {
+        "width": "container",
+        "mark": {"type": "bar", "tooltip": True},
+        "encoding": {
+            "x": {"field": "x", "type": "ordinal", "sort": None, "title": x_title},
+            "y": {"field": "Usuários únicos", "type": "quantitative", "stack": "zero"},
+            "color": {"field": "Horário", "type": "nominal", "sort": BUCKETS},
+        },
+    }
+    st.vega_lite_chart(long, spec)
+
+@st.fragment
+def data_section(df: pd.DataFrame, df_unicos: pd.DataFrame) -> None:
+    # fragmento: os toggles reexecutam só este trecho; tabela e CSV só são
+    # montados quando o usuário pede
+    if st.toggle("Eventos (amostra)", key="show_eventos"):
+        st.dataframe(df.head(5000))
+        st.download_button("Baixar CSV (eventos)", csv_bytes(df), "eventos.csv", "text/csv")
+    if st.toggle("Primeiro contato por usuário", key="show_unicos"):
+        st.dataframe(df_unicos)
+        st.download_button("Baixar CSV (usuários únicos)", csv_bytes(df_unicos), "usuarios_unicos.csv", "text/csv")
+
 # ------------------------- Execução -------------------------
 
+# parâmetros que definem a análise; em "Últimos N dias" vale o N, para o fim móvel
+# da janela não marcar o resultado como desatualizado a cada minuto
+periodo = (period_mode, days) if period_mode == "Últimos N dias" else (to_iso_z(start_dt), to_iso_z(end_dt))
+params = (action, periodo, tz_name, start_h, end_h, int(take), int(max_events))
+
 if run:
     if not api_key:
         st.error("Cole sua **BLIP_API_KEY** em Credenciais e tente novamente.")
@@ -245,12 +513,33 @@ if run:
     start_iso, end_iso = to_iso_z(start_dt), to_iso_z(end_dt)
 
     with st.status("Buscando eventos...", expanded=True):
-        raw = fetch_events(api_key, action, start_iso, end_iso, take=take, max_events=max_events)
+        key_hash = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+        incompleto = False
+        try:
+            raw, raw_digest = _cached_fetch(action, start_iso, end_iso, int(take), int(max_events), key_hash, api_key)
+        except IncompleteFetch as e:
+            raw, raw_digest = e.items, payload_digest(e.items)
+            incompleto = True
         st.write(f"Eventos coletados: **{len(raw)}**")
 
-    df, df_unicos = preprocess_and_unique(raw, tz_name, start_h, end_h)
+    df, df_unicos = preprocess_and_unique(raw, raw_digest, tz_name, start_h, end_h)
     metrics = summarize(df_unicos)
 
+    # persiste na sessão: interações posteriores redesenham sem refazer coleta/processamento
+    st.session_state["df"] = df
+    st.session_state["df_unicos"] = df_unicos
+    st.session_state["metrics"] = metrics
+    st.session_state["params"] = params
+    st.session_state["incompleto"] = incompleto
+
+metrics = st.session_state.get("metrics")
+if metrics is not None:
+    df, df_unicos = st.session_state["df"], st.session_state["df_unicos"]
+    if st.session_state.get("incompleto"):
+        st.warning("A coleta foi interrompida por erro: os resultados abaixo são parciais. Clique em **Buscar & Analisar** para tentar de novo.")
+    if st.session_state.get("params") != params:
+        st.warning("Parâmetros alterados desde a última análise: os resultados abaixo estão desatualizados. Clique em **Buscar & Analisar** para atualizar.")
+
     # KPIs
     col1, col2, col3 = st.columns(3)
     total = metrics["total"]
@@ -261,46 +550,26 @@ if run:
     col2.metric("Dentro do comercial", f"{dentro}", f"{(dentro/max(total,1))*100:.1f}%")
     col3.metric("Fora do comercial", f"{fora}", f"{(fora/max(total,1))*100:.1f}%")
 
-    # Gráficos simples (matplotlib)
+    # Gráficos (Vega-Lite, renderizados no navegador)
     st.subheader("Distribuição Dentro vs Fora")
     if total > 0:
-        fig1, ax1 = plt.subplots()
-        metrics["resumo"].set_index("Horário")["Usuários únicos"].plot.pie(autopct="%1.1f%%", startangle=90, ax=ax1)
-        ax1.set_ylabel("")
-        st.pyplot(fig1)
+        pie_chart(metrics["resumo"])
     else:
         st.info("Sem dados para o gráfico de pizza.")
 
     c1, c2 = st.columns(2)
     with c1:
         st.subheader("Por semana (ISO)")
-        fig2, ax2 = plt.subplots(figsize=(7,4))
-        if not metrics["semana"].empty:
-            metrics["semana"].plot(kind="bar", stacked=True, ax=ax2)
-        ax2.set_ylabel("Usuários únicos"); ax2.set_xlabel("Semana")
-        st.pyplot(fig2)
+        stacked_bar(metrics["semana"], "Semana")
     with c2:
         st.subheader("Por dia da semana")
-        fig3, ax3 = plt.subplots(figsize=(7,4))
-        if not metrics["dia"].empty:
-            metrics["dia"].plot(kind="bar", stacked=True, ax=ax3)
-        ax3.set_ylabel("Usuários únicos"); ax3.set_xlabel("Dia")
-        st.pyplot(fig3)
+        stacked_bar(metrics["dia"], "Dia")
 
     st.subheader("Por hora do dia")
-    fig4, ax4 = plt.subplots(figsize=(10,4))
-    if not metrics["hora"].empty:
-        metrics["hora"].plot(kind="bar", stacked=True, ax=ax4)
-    ax4.set_ylabel("Usuários únicos"); ax4.set_xlabel("Hora")
-    st.pyplot(fig4)
-
-    # Dados e export mínimo
-    with st.expander("Eventos (amostra)"):
-        st.dataframe(df.head(5000))
-        st.download_button("Baixar CSV (eventos)", df.to_csv(index=False).encode("utf-8"), "eventos.csv", "text/csv")
-    with st.expander("Primeiro contato por usuário"):
-        st.dataframe(df_unicos)
-        st.download_button("Baixar CSV (usuários únicos)", df_unicos.to_csv(index=False).encode("utf-8"), "usuarios_unicos.csv", "text/csv")
+    stacked_bar(metrics["hora"], "Hora")
+
+    # Dados e export mínimo (sob demanda)
+    data_section(df, df_unicos)
 else:
     st.info("Ajuste os parâmetros, cole a chave e clique em **Buscar & Analisar**.")
 